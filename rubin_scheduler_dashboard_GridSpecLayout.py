@@ -1,10 +1,14 @@
+import asyncio
 import param
 import pandas as pd
 import panel as pn
-import numpy as np   # used once; not really neccessary
-import bokeh
+import numpy as np
 import logging
 import os
+import copy
+import datetime
+import urllib.request
+import threading
 
 from astropy.time import Time
 from zoneinfo import ZoneInfo
@@ -97,14 +101,29 @@ Pending questions
 """
 
 DEFAULT_TIMEZONE        = "Chile/Continental"
+DEFAULT_TZINFO          = ZoneInfo(DEFAULT_TIMEZONE)
 DEFAULT_CURRENT_TIME    = Time.now()
 DEFAULT_SCHEDULER_FNAME = "scheduler.pickle.xz"
-
-color_palettes = [s for s in bokeh.palettes.__palettes__ if "256" in s]
+TABLE_PAGE_SIZE         = 25                                                   # Tables with more rows than this are paginated.
+MJD_UNIX_EPOCH          = 40587                                                # MJD of 1970-01-01T00:00:00 UTC.
+MAX_TEXT_LENGTH         = 40                                                   # Longer table text is truncated.
+NSIDE_PREVIEW           = 8                                                    # Maps are drawn at this nside first, then refined.
+SPARSE_MAX_FRACTION     = 0.5                                                  # Maps with more finite pixels than this are kept dense.
+DATE_DEBOUNCE           = 0.5                                                  # Seconds a new date must stay chosen before it is used.
+
+COLOR_PALETTES = ("Greys256",                                                  # The 256-colour palettes of bokeh.palettes.
+                  "Inferno256",
+                  "Magma256",
+                  "Plasma256",
+                  "Viridis256",
+                  "Cividis256",
+                  "Turbo256")
 
 LOGO      = "/Users/me/Documents/2023/ADACS/Panel_scheduler/Rubin_scheduler_dashboard/lsst_white_logo.png"
 key_image = "/Users/me/Documents/2023/ADACS/Panel_scheduler/Rubin_scheduler_dashboard/key_image.png"
 
+ASSETS_URL = "/assets"                                                         # Serves the directory holding LOGO and key_image.
+
 pn.extension("tabulator",
              css_files   = [pn.io.resources.CSS_URLS["font-awesome"]],
              sizing_mode = "stretch_width",)
@@ -120,7 +139,171 @@ debug_info = pn.widgets.Debugger(name        = "Debugger information.",
                                  level       = logging.DEBUG,
                                  sizing_mode = "stretch_both")
 
-terminal = pn.widgets.Terminal(height=100, sizing_mode='stretch_width')
+# Write warnings and errors logged for a session to that session's terminal
+# (passed as the record's "terminal"), so a single logging call reaches both
+# the console and the dashboard. Only this module's logger has the handler, so
+# messages of other libraries stay out of the dashboard.
+class TerminalHandler(logging.Handler):
+    def emit(self, record):
+        terminal = getattr(record, "terminal", None)
+        if terminal is not None:
+            terminal.write(f"\n {self.format(record)}")
+
+
+logger = logging.getLogger(__name__)
+
+terminal_handler = TerminalHandler(level=logging.WARNING)
+terminal_handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+logger.addHandler(terminal_handler)
+
+# Images are served as static files (see pn.serve below), so browsers fetch
+# and cache them instead of receiving them in every session's document.
+logo_pane      = pn.pane.HTML(f'<img src="{ASSETS_URL}/{os.path.basename(LOGO)}" style="height:100%">',
+                               sizing_mode='stretch_height',
+                               align='center', margin=(5,5,5,5))
+key_image_pane = pn.pane.HTML(f'<img src="{ASSETS_URL}/{os.path.basename(key_image)}" height=200>')
+
+
+# Columns sent to the survey rewards and basis function tables.
+SURVEY_COLUMNS         = ['survey_name',
+                          'reward',
+                          'survey_url']
+BASIS_FUNCTION_COLUMNS = ['basis_function',
+                          'basis_function_class',
+                          'feasible',
+                          'max_basis_reward',
+                          'basis_area',
+                          'basis_weight',
+                          'max_accum_reward',
+                          'accum_area',
+                          'doc_url']
+
+
+# Shorten text longer than MAX_TEXT_LENGTH, marking the cut with an ellipsis.
+def truncate_text(text):
+    return text if len(text) <= MAX_TEXT_LENGTH else text[:MAX_TEXT_LENGTH] + '…'
+
+
+# Cast float64 columns to float32; nothing displayed needs double precision.
+# Object columns holding only numbers are first given numeric dtypes, so Bokeh
+# sends them to the browser as binary arrays rather than as JSON lists.
+def downcast_floats(df):
+    df = df.infer_objects()
+    return df.astype({col: 'float32' for col in df.select_dtypes('float64').columns})
+
+
+# Cast a float64 HEALPix map to float32; palettes only have 256 colours.
+def downcast_map(hpix_map):
+    if isinstance(hpix_map, np.ndarray) and hpix_map.dtype == np.float64:
+        return hpix_map.astype(np.float32)
+    return hpix_map
+
+
+# Store a HEALPix map as the indices and values of its finite pixels, with
+# the remaining pixels sharing one sentinel value (as healsparse does). Only
+# maps that are mostly non-finite are stored this way, as the index kept for
+# each finite pixel otherwise costs more than the pixels it leaves out. Maps
+# whose remaining pixels mix values (e.g. nan and -inf) are kept dense too.
+def to_sparse(hpix_map):
+    if not isinstance(hpix_map, np.ndarray):
+        return hpix_map
+    mask = np.isfinite(hpix_map)
+    if np.count_nonzero(mask) >= SPARSE_MAX_FRACTION*hpix_map.size:             # Also keeps integer maps dense.
+        return hpix_map
+    sentinel = hpix_map[~mask]
+    if not (np.all(np.isnan(sentinel)) or np.all(sentinel == sentinel[0])):
+        return hpix_map
+    return (np.nonzero(mask)[0].astype('int32'), hpix_map[mask], sentinel[0], hpix_map.size)
+
+
+# Rebuild a dense HEALPix map stored by to_sparse.
+def from_sparse(sparse_map):
+    if not isinstance(sparse_map, tuple):
+        return sparse_map
+    (pixels, values, sentinel, npix) = sparse_map
+    hpix_map = np.full(npix, sentinel, dtype=values.dtype)
+    hpix_map[pixels] = values
+    return hpix_map
+
+
+# Modification time of a scheduler pickle: that of the file, or the ETag or
+# Last-Modified header of a URL. None if it cannot be found.
+def scheduler_pickle_mtime(fname):
+    if os.path.exists(fname):
+        return os.path.getmtime(fname)
+    try:
+        with urllib.request.urlopen(urllib.request.Request(fname, method='HEAD')) as response:
+            return response.headers.get('ETag') or response.headers.get('Last-Modified')
+    except Exception:
+        return None
+
+
+# Read a scheduler pickle, keeping the last few read in memory. The pickle's
+# modification time is part of the key, so a rewritten pickle is read again.
+@pn.cache(max_items=8, policy='LRU')
+def read_scheduler_cached(fname, mtime):
+    return schedview.collect.scheduler_pickle.read_scheduler(fname)
+
+
+# Read a scheduler pickle and update it to a date. The result is shared by all
+# sessions viewing that pickle and date. Computing rewards, maps and basis
+# function tables still updates its surveys and basis functions in place, so
+# computations on it must not overlap, even when they come from different
+# sessions. Callers hold the returned lock while computing with it; the lock is
+# cached with the scheduler it guards, so it is dropped when that is evicted.
+@pn.cache(max_items=4, policy='LRU')
+def read_scheduler_at(fname, mtime, mjd):
+    (scheduler, conditions) = copy.deepcopy(read_scheduler_cached(fname, mtime))
+    conditions.mjd = mjd
+    scheduler.update_conditions(conditions)
+    return scheduler, conditions, threading.Lock()
+
+
+# Compute the survey rewards of a scheduler pickle at a date. The basis function
+# rewards are split by (tier_id, survey_id) and the surveys by tier, so changing
+# tier or survey is a lookup. Only the table columns are kept in the split of
+# surveys, to keep the data sent to the browser small.
+@pn.cache(max_items=64, policy='LRU', ttl=3600)
+def compute_survey_rewards(fname, mtime, mjd):
+    (scheduler, conditions, scheduler_lock) = read_scheduler_at(fname, mtime, mjd)
+    with scheduler_lock:
+        rewards        = scheduler.make_reward_df(conditions)
+        survey_rewards = schedview.compute.scheduler.make_scheduler_summary_df(scheduler,
+                                                                               conditions,
+                                                                               rewards)
+    rewards_by_survey      = {survey: group for survey, group in downcast_floats(rewards).groupby(level=[0, 1])}
+    survey_rewards_by_tier = {tier: downcast_floats(group[SURVEY_COLUMNS].reset_index(drop=True))
+                              for tier, group in survey_rewards.groupby('tier', sort=False)}
+    return rewards_by_survey, survey_rewards, survey_rewards_by_tier
+
+
+# Compute the maps of a survey of a scheduler pickle at a date, stored sparse.
+@pn.cache(max_items=64, policy='LRU', ttl=3600)
+def compute_survey_maps(fname, mtime, mjd, tier_id, survey_id, nside):
+    (scheduler, conditions, scheduler_lock) = read_scheduler_at(fname, mtime, mjd)
+    with scheduler_lock:
+        survey_maps = schedview.compute.survey.compute_maps(scheduler.survey_lists[tier_id][survey_id],
+                                                            conditions,
+                                                            nside)
+    return {name: to_sparse(downcast_map(survey_map)) for name, survey_map in survey_maps.items()}
+
+
+# Compute the basis function table of a survey of a scheduler pickle at a date.
+# Only the truncated class names are sent to the table; the full names are
+# returned separately and shown when a row is expanded.
+@pn.cache(max_items=64, policy='LRU', ttl=3600)
+def compute_basis_functions(fname, mtime, mjd, tier_id, survey_id):
+    (scheduler, conditions, scheduler_lock) = read_scheduler_at(fname, mtime, mjd)
+    # Fetched before taking the lock, which compute_survey_rewards also takes.
+    (rewards_by_survey, _, _) = compute_survey_rewards(fname, mtime, mjd)
+    with scheduler_lock:
+        basis_function_df = schedview.compute.survey.make_survey_reward_df(scheduler.survey_lists[tier_id][survey_id],
+                                                                           conditions,
+                                                                           rewards_by_survey[(tier_id, survey_id)])
+    basis_functions = downcast_floats(basis_function_df[BASIS_FUNCTION_COLUMNS].reset_index(drop=True))
+    basis_function_classes = basis_functions['basis_function_class'].astype(str).to_numpy()
+    basis_functions['basis_function_class'] = [truncate_text(text) for text in basis_function_classes]
+    return basis_functions, basis_function_classes
 
 
 
@@ -134,37 +317,100 @@ class Scheduler(param.Parameterized):
     survey          = param.Integer(default=-1)
     basis_function  = param.Integer(default=-1)
     survey_map      = param.ObjectSelector(default="", objects=[""])
-    plot_display    = param.Integer(default=1)
     nside           = param.ObjectSelector(default=16,
                                            objects=[2**n for n in np.arange(1, 6)],
                                            label="Map resolution (nside)")
-    color_palette   = param.ObjectSelector(default="Magma256",
-                                           objects=color_palettes)
-    debug_string    = param.String(default="")
+    color_palette   = param.Selector(default="Magma256",
+                                     objects=COLOR_PALETTES)
 
-    _scheduler                = param.Parameter(None)
-    _conditions               = param.Parameter(None)
+    _scheduler                = param.Parameter(None)                          # not used in @depends method
+    _conditions               = param.Parameter(None)                          # not used in @depends method
+    _scheduler_key            = param.Parameter(None)
+    _scheduler_date_key       = param.Parameter(None)                          # not used in @depends method
     _date_time                = param.Parameter(None)
-    _rewards                  = param.Parameter(None)                          # not used in @depends method
     _survey_rewards           = param.Parameter(None)
+    _survey_rewards_by_tier   = param.Parameter(None)                          # not used in @depends method
+    _tier_id_by_name          = param.Parameter(None)                          # not used in @depends method
     _listed_survey            = param.Parameter(None)
     _survey_maps              = param.Parameter(None)
+    _survey_maps_nside        = param.Parameter(None)                          # not used in @depends method
     _tier_survey_rewards      = param.Parameter(None)
+    _tier_survey_names        = param.Parameter(None)                          # not used in @depends method
     _basis_functions          = param.Parameter(None)
+    _basis_function_names     = param.Parameter(None)                          # not used in @depends method
+    _basis_function_classes   = param.Parameter(None)                          # not used in @depends method
     _survey_df_widget         = param.Parameter(None)
     _basis_function_df_widget = param.Parameter(None)
-    _debugging_message        = param.Parameter(None)
+    
+    
+    def __init__(self, **params):
+        super().__init__(**params)
+        # Tables are built once; later updates only replace their data so the
+        # browser patches the existing table rather than rebuilding it.
+        survey_formatter = {'survey_name': {'type': 'link',
+                                            'labelField':'survey_name',
+                                            'urlField':'survey_url',
+                                            'target':'_blank'}}
+        self._survey_df_widget = pn.widgets.Tabulator(pd.DataFrame(),
+                                                      widths={'survey_name':'60%','reward':'40%'},
+                                                      show_index=False,
+                                                      formatters=survey_formatter,
+                                                      disabled=True,
+                                                      selectable=1,
+                                                      frozen_columns=['survey_name'],
+                                                      hidden_columns=['survey_url'],
+                                                      page_size=TABLE_PAGE_SIZE,
+                                                      #height=200,
+                                                      sizing_mode='stretch_width',
+                                                      #sizing_mode='stretch_both',
+                                                      )
+        basis_function_formatter = {'basis_function': {'type': 'link',
+                                                       'labelField':'basis_function',
+                                                       'urlField':'doc_url',
+                                                       'target':'_blank'}}
+        self._basis_function_df_widget = pn.widgets.Tabulator(pd.DataFrame(),
+                                                              layout="fit_columns",
+                                                              show_index=False,
+                                                              formatters=basis_function_formatter,
+                                                              disabled=True,
+                                                              frozen_columns=['basis_function'],
+                                                              hidden_columns=['doc_url'],
+                                                              row_content=self._basis_function_row_content,
+                                                              selectable=1,
+                                                              page_size=TABLE_PAGE_SIZE,
+                                                              height=400,
+                                                              #sizing_mode='stretch_both',
+                                                              )
+        # Heavy computations run in a worker thread, one at a time per session
+        # so that outdated ones can be skipped. The shared schedulers are
+        # guarded by the locks cached with them in read_scheduler_at.
+        self._compute_lock = asyncio.Lock()
+        # Each session reports its warnings and errors to its own terminal.
+        self._terminal = pn.widgets.Terminal(height=100, sizing_mode='stretch_width')
+        self._logger   = logging.LoggerAdapter(logger, {"terminal": self._terminal})
+        # Title panes are kept for the life of the dashboard and only their
+        # text is changed, so the layout around them is not rebuilt.
+        self._dashboard_title_pane            = pn.pane.Str('Scheduler Dashboard',
+                                                            styles={'font-size':'16pt',
+                                                                    'color':'white',
+                                                                    'font-weight':'bold'})
+        self._survey_rewards_title_pane       = pn.pane.Str('', styles={'font-size':'14pt',
+                                                                        'color':'white'})
+        self._basis_function_table_title_pane = pn.pane.Str('', styles={'font-size':'14pt',
+                                                                        'color':'white'})
+        self._map_title_pane                  = pn.pane.Str('', styles={'font-size':'14pt',
+                                                                        'color':'white'})
     
     
     # Dashboard headings ------------------------------------------------------# Should these functions be below others?
     
-    # Panel for dashboard title.
-    @param.depends("tier", "survey", "plot_display", "survey_map", "basis_function")
-    def dashboard_title(self):
+    # Update dashboard title.
+    @param.depends("tier", "survey", "survey_map", "basis_function", watch=True)
+    def _update_dashboard_title(self):
         titleT  = ''; titleS  = ''; titleBF = ''; titleM = ''
         if self._scheduler is not None:
             if self.tier != '':
-                titleT = '\nTier {}'.format(self.tier[-1])
+                titleT = '\nTier {}'.format(self._tier_id_by_name[self.tier])
                 if self.survey >= 0:
                     titleS = ' | Survey {}'.format(self.survey)
                     if self.plot_display == 1:
@@ -172,100 +418,112 @@ class Scheduler(param.Parameterized):
                     elif self.plot_display == 2 and self.basis_function >= 0:
                         titleBF = ' | Basis function {}'.format(self.basis_function)
         title_string = 'Scheduler Dashboard' + titleT + titleS + titleBF + titleM
-        dashboard_title = pn.pane.Str(title_string,styles={'font-size':'16pt',
-                                                           'color':'white',
-                                                           'font-weight':'bold'})
-        return dashboard_title
+        self._dashboard_title_pane.object = title_string
 
 
-    # Panel for survey rewards table title.
-    @param.depends("tier")
-    def survey_rewards_title(self):
+    # Update survey rewards table title.
+    @param.depends("tier", watch=True)
+    def _update_survey_rewards_title(self):
         title_string = ''
         if self._scheduler is not None and self.tier != '':
-            title_string = 'Tier {} survey rewards'.format(self.tier[-1])
-        survey_rewards_title = pn.pane.Str(title_string, styles={'font-size':'14pt',
-                                                                 'color':'white'})
-        return survey_rewards_title
+            title_string = 'Tier {} survey rewards'.format(self._tier_id_by_name[self.tier])
+        self._survey_rewards_title_pane.object = title_string
 
 
-    # Panel for basis function table title.
-    @param.depends("survey")
-    def basis_function_table_title(self):        
+    # Update basis function table title.
+    @param.depends("survey", watch=True)
+    def _update_basis_function_table_title(self):
         if self._scheduler is not None and self.survey >= 0:
-            title_string = 'Basis functions for survey {}'.format(self._tier_survey_rewards.reset_index()['survey_name'][self.survey])
+            title_string = 'Basis functions for survey {}'.format(self._tier_survey_names[self.survey])
         else:
             title_string = ''
-        basis_function_table_title = pn.pane.Str(title_string, styles={'font-size':'14pt',
-                                                                       'color':'white'})
-        return basis_function_table_title
+        self._basis_function_table_title_pane.object = title_string
 
 
-    # Panel for map title.
-    @param.depends("survey", "plot_display", "survey_map", "basis_function")
-    def map_title(self):
+    # Update map title.
+    @param.depends("survey", "survey_map", "basis_function", watch=True)
+    def _update_map_title(self):
         if self._scheduler is not None and self.survey >= 0:
-            titleA = 'Survey {}\n'.format(self._tier_survey_rewards.reset_index()['survey_name'][self.survey])
+            titleA = 'Survey {}\n'.format(self._tier_survey_names[self.survey])
             if self.plot_display == 1:
                 titleB = 'Map {}'.format(self.survey_map)
             elif self.plot_display == 2 and self.basis_function >= 0:
                 titleB = 'Basis function {}: {}'.format(self.basis_function,
-                                                        self._basis_functions['basis_function'][self.basis_function])
+                                                        self._basis_function_names[self.basis_function])
             else:
                 titleA = ''; titleB = ''
             title_string = titleA + titleB
         else:
             title_string = ''
-        map_title = pn.pane.Str(title_string, styles={'font-size':'14pt',
-                                                      'color':'white'})
-        return map_title
+        self._map_title_pane.object = title_string
 
     
     # Widgets and updates -----------------------------------------------------
     
     # Update scheduler if given new pickle file.
     @param.depends("scheduler_fname", watch=True)
-    def _update_scheduler(self):
+    async def _update_scheduler(self):
         logging.info("Updating scheduler.")
         try:
-            (scheduler, conditions) = schedview.collect.scheduler_pickle.read_scheduler(self.scheduler_fname)
-            self._scheduler = scheduler
-            self._conditions = conditions
+            mtime = await asyncio.to_thread(scheduler_pickle_mtime, self.scheduler_fname)
+            await asyncio.to_thread(read_scheduler_cached, self.scheduler_fname, mtime)
         except Exception as e:
-            logging.error(f"Could not load scheduler from {self.scheduler_fname} {e}")
-            self._debugging_message = f"Could not load scheduler from {self.scheduler_fname}: {e}"
-            terminal.write(f"\n {Time.now().iso} - Could not load scheduler from {self.scheduler_fname}: {e}")
+            self._logger.error(f"Could not load scheduler from {self.scheduler_fname}: {e}")
+            return
+        self._scheduler_key = (self.scheduler_fname, mtime)
     
     
-    # Update datetime if new datetime chosen.
+    # Update datetime once a new date has stayed chosen for DATE_DEBOUNCE
+    # seconds, so dates passed through while picking are not each computed.
     @param.depends("date", watch=True)
+    async def _debounce_date(self):
+        date = self.date
+        await asyncio.sleep(DATE_DEBOUNCE)
+        if date == self.date:                                                  # Not replaced by a newer date.
+            self._update_date_time()
+
+
+    # Update datetime from the chosen date.
     def _update_date_time(self):
         logging.info("Updating date.")
-        self._date_time = Time(pd.Timestamp(self.date, tzinfo=ZoneInfo("Chile/Continental"))).mjd
+        if isinstance(self.date, datetime.datetime):
+            date_time = self.date
+        else:
+            date_time = datetime.datetime.combine(self.date, datetime.time())
+        date_time = date_time.replace(tzinfo=DEFAULT_TZINFO)
+        self._date_time = MJD_UNIX_EPOCH + date_time.timestamp()/86400.0
         logging.info("Date updated to {}".format(self._date_time))
     
     
     # Update survey reward table if given new pickle file or new date.
-    @param.depends("_scheduler", "_conditions", "_date_time", watch=True)
-    def _update_survey_rewards(self):
-        if self._scheduler is None:
+    @param.depends("_scheduler_key", "_date_time", watch=True)
+    async def _update_survey_rewards(self):
+        if self._scheduler_key is None:
             logging.info("No pickle loaded.")
             return
-        logging.info("Updating survey rewards.")
-        try:
-            self._conditions.mjd = self._date_time
-            self._scheduler.update_conditions(self._conditions)
-            self._rewards  = self._scheduler.make_reward_df(self._conditions)
-            survey_rewards = schedview.compute.scheduler.make_scheduler_summary_df(self._scheduler,
-                                                                                   self._conditions,
-                                                                                   self._rewards)
+        (scheduler_key, date_time) = (self._scheduler_key, self._date_time)
+        async with self._compute_lock:
+            # Skip if a newer pickle or date was chosen while waiting.
+            if scheduler_key != self._scheduler_key or date_time != self._date_time:
+                return
+            logging.info("Updating survey rewards.")
+            try:
+                (scheduler, conditions, _) = await asyncio.to_thread(read_scheduler_at, *scheduler_key, date_time)
+                (_,
+                 survey_rewards,
+                 survey_rewards_by_tier) = await asyncio.to_thread(compute_survey_rewards, *scheduler_key, date_time)
+            except Exception as e:
+                self._logger.error(f"Survey rewards table unable to be updated: {e}")
+                logging.info("Perhaps date not in range of pickle data?")
+                (scheduler, conditions, survey_rewards, survey_rewards_by_tier) = (None, None, None, None)
+        if scheduler_key != self._scheduler_key or date_time != self._date_time:  # Overtaken while computing.
+            return
+        with pn.io.hold():                                                     # Tier, tables and titles update together.
+            self._scheduler = scheduler
+            self._conditions = conditions
+            self._scheduler_date_key = None if scheduler is None else (*scheduler_key, date_time)
+            self._survey_rewards_by_tier = survey_rewards_by_tier              # Read by the _survey_rewards watchers, so set first.
             self._survey_rewards = survey_rewards
-        except Exception as e:
-            logging.error(e)
-            logging.info("Survey rewards table unable to be updated. Perhaps date not in range of pickle data?")
-            self._debugging_message = "Survey rewards table unable to be updated: " + str(e)
-            terminal.write(f"\n {Time.now().iso} - Survey rewards table unable to be updated: {e}")
-            self._survey_rewards = None
 
 
     # Update available tier selections if given new pickle file.
@@ -273,28 +531,28 @@ class Scheduler(param.Parameterized):
     def _update_tier_selector(self):
         logging.info("Updating tier selector.")
         if self._survey_rewards is None:
-            self.param["tier"].objects = [""]
-            self.tier = ""
-            return
-        tiers = self._survey_rewards.tier.unique().tolist()
+            tiers = [""]
+        else:
+            tiers = list(self._survey_rewards_by_tier.keys())
+            self._tier_id_by_name = {tier: int(tier.rsplit(' ', 1)[-1]) for tier in tiers}
         self.param["tier"].objects = tiers
-        self.tier = tiers[0]
+        if self.tier == tiers[0]:
+            self.param.trigger("tier")                                         # Same tier, but its surveys have changed.
+        else:
+            self.tier = tiers[0]
 
 
     # Update (filter) survey list based on tier selection.
-    @param.depends("_survey_rewards", "tier", watch=True)
+    @param.depends("tier", watch=True)
     def _update_survey_reward_table(self):
         if self._survey_rewards is None:
+            self._tier_survey_names = None
             self._tier_survey_rewards = None
             return
         logging.info("Updating survey rewards for chosen tier.")
-        try:
-            self._tier_survey_rewards = self._survey_rewards[self._survey_rewards['tier']==self.tier]
-        except Exception as e:
-            logging.error(e)
-            self._debugging_message = "Survey rewards unable to be updated: " + str(e)
-            terminal.write(f"\n {Time.now().iso} - Survey rewards unable to be updated: {e}")
-            self._tier_survey_rewards = None
+        tier_survey_rewards = self._survey_rewards_by_tier.get(self.tier)
+        self._tier_survey_names = None if tier_survey_rewards is None else tier_survey_rewards['survey_name'].to_numpy()
+        self._tier_survey_rewards = tier_survey_rewards
 
 
     # Widget for survey reward table.
@@ -302,28 +560,18 @@ class Scheduler(param.Parameterized):
     def survey_rewards_table(self):
         if self._tier_survey_rewards is None:
             return "No surveys available."
-        tabulator_formatter = {'survey_name': {'type': 'link',
-                                                'labelField':'survey_name',
-                                                'urlField':'survey_url',
-                                                'target':'_blank'}}
-        survey_rewards_table = pn.widgets.Tabulator(self._tier_survey_rewards[['tier','survey_name','reward','survey_url']],
-                                                    widths={'survey_name':'60%','reward':'40%'},
-                                                    show_index=False,
-                                                    formatters=tabulator_formatter,
-                                                    disabled=True,
-                                                    selectable=1,
-                                                    hidden_columns=['tier','survey_url'],
-                                                    #height=200,
-                                                    sizing_mode='stretch_width',
-                                                    #sizing_mode='stretch_both',
-                                                    )
+        survey_rewards = self._tier_survey_rewards
+        # Replace the data in place; rows selected in the previous table no longer apply.
+        self._survey_df_widget.param.update(selection=[],
+                                            pagination='remote' if len(survey_rewards) > TABLE_PAGE_SIZE else None,
+                                            value=survey_rewards)
         logging.info("Finished updating survey rewards table.")
-        self._survey_df_widget = survey_rewards_table
-        return survey_rewards_table
+        return self._survey_df_widget
 
 
     # Update selected survey based on row selection of survey_rewards_table.
     @param.depends("_survey_df_widget.selection", watch=True)
+    @pn.io.hold()
     def update_survey_with_row_selection(self):
         logging.info("Updating survey row selection.")
         if self._survey_df_widget.selection == []:
@@ -332,9 +580,7 @@ class Scheduler(param.Parameterized):
         try:
             self.survey = self._survey_df_widget.selection[0]
         except Exception as e:
-            logging.error(e)
-            self._debugging_message = "Survey selection unable to be updated: " + str(e)
-            terminal.write(f"\n {Time.now().iso} - Survey selection unable to be updated: {e}")
+            self._logger.error(f"Survey selection unable to be updated: {e}")
             self.survey = -1                                                   # When no survey selected, survey = -1
     
     
@@ -342,76 +588,115 @@ class Scheduler(param.Parameterized):
     @param.depends("survey", watch=True)
     def _update_listed_survey(self):
         logging.info("Updating listed survey.")
-        try:
-            tier_id = int(self.tier[-1])
-            survey_id = self.survey
-            self._listed_survey = self._scheduler.survey_lists[tier_id][survey_id]
-        except Exception as e:
-            logging.error(e)
-            self._debugging_message = "Listed survey unable to be updated: " + str(e)
-            terminal.write(f"\n {Time.now().iso} - Listed survey unable to be updated: {e}")
+        if self.tier == "" or self.survey < 0:
             self._listed_survey = None
+            return
+        self._listed_survey = self._scheduler.survey_lists[self._tier_id_by_name[self.tier]][self.survey]
     
 
     # Update available map selections if new survey chosen.                    # Add try-catch here?
     @param.depends("_listed_survey", watch=True)
-    def _update_map_selector(self):
+    async def _update_map_selector(self):
         if self.tier == "" or self.survey < 0:
-            self.param["survey_map"].objects = [""]
-            self.survey_map = ""
+            self._clear_map_selector()
             return
         logging.info("Updating map selector.")
-        self._survey_maps = schedview.compute.survey.compute_maps(self._listed_survey,
-                                                                  self._conditions,
-                                                                  self.nside)
+        (listed_survey, nside) = (self._listed_survey, self.nside)
+        # Draw coarse maps first, so a map appears quickly, then refine them.
+        preview_nside = min(NSIDE_PREVIEW, nside)
+        survey_maps = await self._compute_maps_cached(self._scheduler_date_key,
+                                                      self._tier_id_by_name[self.tier],
+                                                      self.survey,
+                                                      preview_nside)
+        if listed_survey is not self._listed_survey:                           # Another survey chosen in the meantime.
+            return
+        self._survey_maps_nside = preview_nside
+        self._survey_maps = survey_maps
         maps = list(self._survey_maps.keys())
-        self.param["survey_map"].objects = maps
         if 'reward' in maps:                                                   # If 'reward' map always exists, then this isn't needed.
-            self.survey_map = maps[-1]                                         # Reward map usually (always?) listed last.
+            survey_map = maps[-1]                                              # Reward map usually (always?) listed last.
         else:
-            self.survey_map = maps[0]
-        self.plot_display = 1
+            survey_map = maps[0]
+        self.param["survey_map"].objects = maps
+        self.param.update(survey_map=survey_map,
+                          basis_function=-1)                                   # Display a map of the new survey.
+        if preview_nside != nside:
+            await self._update_nside_of_maps()
         
     
     # Update map selections when nside changed.                                # Add try-catch here?
     @param.depends("nside", watch=True)
-    def _update_nside_of_maps(self):
+    async def _update_nside_of_maps(self):
         if self.tier == "" or self.survey < 0:
-            self.param["survey_map"].objects = [""]
-            self.survey_map = ""
+            self._clear_map_selector()
             return
         logging.info("Updating map resolution (nside).")
-        self._survey_maps = schedview.compute.survey.compute_maps(self._listed_survey,
-                                                                  self._conditions,
-                                                                  self.nside)
-
-    # Update the parameter which determines whether a basis function or a map is plotted.
-    @param.depends("survey_map", watch=True)
-    def _update_plot_display(self):
-        logging.info("Updating parameter for basis/map display.")
-        #self.plot_display = 1                                                  # Display map instead of basis function.
-        if self.survey_map != "":
-            self.plot_display = 1
+        (listed_survey, nside) = (self._listed_survey, self.nside)
+        survey_maps = await self._compute_maps_cached(self._scheduler_date_key,
+                                                      self._tier_id_by_name[self.tier],
+                                                      self.survey,
+                                                      nside)
+        if listed_survey is not self._listed_survey or nside != self.nside:    # Selection changed in the meantime.
+            return
+        self._survey_maps_nside = nside
+        self._survey_maps = survey_maps
+    
+    
+    # Leave only the empty map selection when no survey is chosen. The maps and
+    # basis function go with it, so sky_map is not redrawn with a stale selection.
+    def _clear_map_selector(self):
+        self.param["survey_map"].objects = [""]
+        self.param.update(_survey_maps=None,
+                          survey_map="",
+                          basis_function=-1)
+
+
+    # Compute maps of a survey, reusing them if already computed for this pickle, date and nside.
+    async def _compute_maps_cached(self, scheduler_date_key, tier_id, survey_id, nside):
+        async with self._compute_lock:
+            survey_maps = await asyncio.to_thread(compute_survey_maps,
+                                                  *scheduler_date_key,
+                                                  tier_id,
+                                                  survey_id,
+                                                  nside)
+        return {name: from_sparse(survey_map) for name, survey_map in survey_maps.items()}
+
+    # Whether a basis function (2) or a map (1) is plotted: a basis function while
+    # one is selected in basis_function_table, otherwise the chosen survey_map.
+    @property
+    def plot_display(self):
+        return 2 if self.basis_function >= 0 else 1
 
 
     # Update basis function table if new survey chosen.
-    @param.depends("_listed_survey", "survey_rewards_table", watch=True)
-    def _update_basis_functions(self):
+    @param.depends("_listed_survey", watch=True)
+    async def _update_basis_functions(self):
         if self._listed_survey is None:
+            with pn.io.hold():
+                self._basis_function_names = None
+                self._basis_function_classes = None
+                self._basis_functions = None
             return
         logging.info("Updating basis function table.")
+        (listed_survey, scheduler_date_key) = (self._listed_survey, self._scheduler_date_key)
+        (tier_id, survey_id) = (self._tier_id_by_name[self.tier], self.survey)     # Selection may change while waiting.
         try:
-            tier_id = int(self.tier[-1])
-            survey_id = self.survey
-            basis_function_df = schedview.compute.survey.make_survey_reward_df(self._listed_survey,
-                                                                               self._conditions,
-                                                                               self._rewards.loc[[(tier_id, survey_id)], :])
-            self._basis_functions = basis_function_df
+            async with self._compute_lock:
+                (basis_functions,
+                 basis_function_classes) = await asyncio.to_thread(compute_basis_functions,
+                                                                   *scheduler_date_key,
+                                                                   tier_id,
+                                                                   survey_id)
+            basis_function_names = basis_functions['basis_function'].to_numpy()
         except Exception as e:
-            logging.error(e)
-            self._debugging_message = "Basis function dataframe unable to be updated: " + str(e)
-            terminal.write(f"\n {Time.now().iso} - Basis function dataframe unable to be updated: {e}")
-            self._basis_functions = None
+            self._logger.error(f"Basis function dataframe unable to be updated: {e}")
+            (basis_functions, basis_function_classes, basis_function_names) = (None, None, None)
+        if listed_survey is not self._listed_survey:                           # Another survey chosen in the meantime.
+            return
+        with pn.io.hold():
+            self._basis_function_names = basis_function_names
+            self._basis_function_classes = basis_function_classes
+            self._basis_functions = basis_functions
 
 
     # Widget for basis function table.
@@ -419,56 +704,40 @@ class Scheduler(param.Parameterized):
     def basis_function_table(self):
         if self._basis_functions is None:
             return "No basis functions available."
-        logging.info("Creating basis function table.")
-        tabulator_formatter = {
-            'basis_function': {'type': 'link',
-                                'labelField':'basis_function',
-                                'urlField':'doc_url',
-                                'target':'_blank'}}
-        columnns = ['basis_function',
-                    'basis_function_class',
-                    'feasible',
-                    'max_basis_reward',
-                    'basis_area',
-                    'basis_weight',
-                    'max_accum_reward',
-                    'accum_area',
-                    'doc_url']
-        basis_function_table = pn.widgets.Tabulator(self._basis_functions[columnns],
-                                                    layout="fit_data",
-                                                    show_index=False,
-                                                    formatters=tabulator_formatter,
-                                                    disabled=True,
-                                                    frozen_columns=['basis_function'],
-                                                    hidden_columns=['doc_url'],
-                                                    selectable=1,
-                                                    #height=500,
-                                                    #sizing_mode='stretch_both',
-                                                    )
-        self._basis_function_df_widget = basis_function_table
-        return basis_function_table
+        logging.info("Filling basis function table.")
+        basis_functions = self._basis_functions
+        self._basis_function_df_widget.param.update(selection=[],
+                                                    expanded=[],
+                                                    pagination='remote' if len(basis_functions) > TABLE_PAGE_SIZE else None,
+                                                    value=basis_functions)
+        return self._basis_function_df_widget
+
+
+    # Full basis function class of an expanded row of basis_function_table.
+    def _basis_function_row_content(self, row):
+        return pn.pane.Str(self._basis_function_classes[row.name],
+                           styles={'font-size':'9pt'})
 
 
     # Update selected basis_function based on row selection of basis_function_table.
     @param.depends("_basis_function_df_widget.selection", watch=True)
+    @pn.io.hold()
     def update_basis_function_with_row_selection(self):
         if self._basis_function_df_widget.selection == []:
+            self.basis_function = -1                                           # Deselected, so maps are displayed again.
             return
         logging.info("Updating basis function row selection.")
         try:
-            self.plot_display = 2                                              # Display basis function instead of a map.
-            self.basis_function = self._basis_function_df_widget.selection[0]
-            logging.info(f"Basis function selection: {self._basis_functions['basis_function'][self.basis_function]}")
+            self.basis_function = self._basis_function_df_widget.selection[0]     # Displayed instead of a map.
+            logging.info(f"Basis function selection: {self._basis_function_names[self.basis_function]}")
         except Exception as e:
-            logging.error(e)
-            self._debugging_message = "Basis function dataframe selection unable to be updated: " + str(e)
-            terminal.write(f"\n {Time.now().iso} - Basis function dataframe selection unable to be updated: {e}")
+            self._logger.error(f"Basis function dataframe selection unable to be updated: {e}")
             self.basis_function = -1                                           # When no basis function selected, basis_function = -1.
 
 
     # Create sky_map of survey for display.
-    @param.depends("_conditions","_survey_maps","plot_display","survey_map","basis_function","nside")
-    def sky_map(self):
+    @param.depends("_survey_maps","survey_map","basis_function")
+    async def sky_map(self):
         if self._conditions is None:
             return "No scheduler loaded."
         if self._survey_maps is None:
@@ -476,67 +745,56 @@ class Scheduler(param.Parameterized):
         try:
             # Load survey map.
             if self.plot_display==1: #self.basis_function == -1:
-                sky_map = schedview.plot.survey.map_survey_healpix(self._conditions.mjd,
-                                                                   self._survey_maps,
-                                                                   self.survey_map,
-                                                                   self.nside)
+                sky_map = await asyncio.to_thread(schedview.plot.survey.map_survey_healpix,
+                                                  self._conditions.mjd,
+                                                  self._survey_maps,
+                                                  self.survey_map,
+                                                  self._survey_maps_nside)
             # Load a basis function map.
             elif self.basis_function!=-1 and self.plot_display==2:
-                bf = self._basis_functions['basis_function'][self.basis_function]
+                bf = self._basis_function_names[self.basis_function]
                 # Is the basis function in the list of survey maps?
                 if any(bf in key for key in self._survey_maps.keys()):
                     # Get key name
                     bf_key = list(key for key in self._survey_maps.keys() if bf in key)[0]
                     # Generate map
-                    sky_map = schedview.plot.survey.map_survey_healpix(self._conditions.mjd,
-                                                                       self._survey_maps,
-                                                                       bf_key,
-                                                                       self.nside)
+                    sky_map = await asyncio.to_thread(schedview.plot.survey.map_survey_healpix,
+                                                      self._conditions.mjd,
+                                                      self._survey_maps,
+                                                      bf_key,
+                                                      self._survey_maps_nside)
                 # If the basis function is not in the list of survey maps, it is scalar.
                 else:
-                    logging.info("Could not load map of scalar basis function.")
-                    self._debugging_message = "Could not load map of scalar basis function."
-                    terminal.write(f"\n {Time.now().iso} - Could not load map of scalar basis function.")
+                    self._logger.warning("Could not load map of scalar basis function.")
                     return "Basis function is a scalar; scalar maps not yet implemented."
                 
             sky_map_figure = sky_map.figure
             logging.info("Map successfully created.")
         except Exception as e:
-            logging.info("Could not load map:")
-            logging.error(e)
-            self._debugging_message = "Could not load map: " + str(e)
-            terminal.write(f"\n {Time.now().iso} - Could not load map: {e}")
+            self._logger.error(f"Could not load map: {e}")
             return "No map loaded."
         return sky_map_figure
     
 
-    # Panel for debugging messages
-    @param.depends("_debugging_message")
-    def debugging_messages(self):
-        if self._debugging_message is None:
-            return
-        self.debug_string += f"\n {Time.now().iso} - {self._debugging_message}"
-        debugging_messages = pn.pane.Str(self.debug_string,
-                                         height=80,
-                                         #width=800,
-                                         #sizing_mode='stretch_width',
-                                         styles={'font-size':'9pt',
-                                                 'color':'black'})
-        return debugging_messages
-    
-
 def scheduler_app(date=None, scheduler_pickle=None):
     
     scheduler = Scheduler()
     
-    if date is not None:
-        scheduler.date = date
+    # Set inputs without triggering updates, then update once both are set.
+    with param.parameterized.discard_events(scheduler):
+        if date is not None:
+            scheduler.date = date
+        
+        if scheduler_pickle is not None:
+            scheduler.scheduler_fname = scheduler_pickle
+        
+        scheduler._update_date_time()
     
     if scheduler_pickle is not None:
-        scheduler.scheduler_fname = scheduler_pickle
+        pn.state.onload(scheduler._update_scheduler)                           # Survey rewards follow from the new scheduler.
     
    
-        # Debugger. - (3 options)
+        # Debugger. - (2 options)
         
         # OPTION 1
         # debug_info
@@ -546,70 +804,62 @@ def scheduler_app(date=None, scheduler_pickle=None):
         #     pn.Spacer(width=10),
         #     pn.Column(
         #         pn.pane.Str(' Debugging', align='center', styles={'font-size':'10pt','color':'black'}),
-        #         terminal,
+        #         scheduler._terminal,
         #         styles={'background':'#EDEDED'}),
         #     pn.Spacer(width=10))
         
-        # OPTION 3
-        # pn.Column(pn.pane.Str(' Debugging', styles={'font-size':'10pt','font-weight':'bold','color':'black'}),
-        #           scheduler.debugging_messages,
-        #           #pn.layout.HSpacer(),
-        #           sizing_mode='stretch_width',
-        #           width_policy='max',
-        #           height=100,
-        #           styles={'background':'#EDEDED'})
-
-    
-    sched_app = pn.GridSpec(sizing_mode='stretch_both', max_height=1000).servable()
-    
-    # Dashboard title.
-    sched_app[0,    :]    = pn.Row(scheduler.dashboard_title,
-                                   pn.layout.HSpacer(),
-                                   pn.pane.PNG(LOGO,
-                                               sizing_mode='scale_height',
-                                               align='center', margin=(5,5,5,5)),
-                                   sizing_mode='stretch_width',
-                                   styles={'background':'#048b8c'})
-    # Parameter inputs (pickle, date, tier)
-    sched_app[1:4,  0:3]  = pn.Param(scheduler,
-                                     parameters=["scheduler_fname","date","tier"],
-                                     widgets={'scheduler_fname':{'widget_type':pn.widgets.TextInput,
-                                                                 'placeholder':'filepath or URL of pickle'},
-                                              'date':pn.widgets.DatetimePicker},
-                                     name="Select pickle file, date and tier.")
-    # Survey rewards table and header.
-    sched_app[1:4,  3:8]  = pn.Row(pn.Spacer(width=10),
-                                   pn.Column(pn.Spacer(height=10),
-                                      pn.Row(scheduler.survey_rewards_title,
-                                             styles={'background':'#048b8c'}),
-                                      pn.param.ParamMethod(scheduler.survey_rewards_table, loading_indicator=True)),
-                                   pn.Spacer(width=10),
-                                   #height=200,
-                                   sizing_mode='stretch_height')
-    # Basis function table and header.
-    sched_app[4:11, 0:8]  = pn.Row(pn.Spacer(width=10),
-                                   pn.Column(pn.Spacer(height=10),
-                                      pn.Row(scheduler.basis_function_table_title,
-                                             styles={'background':'#048b8c'}),
-                                      pn.param.ParamMethod(scheduler.basis_function_table, loading_indicator=True)),
-                                   pn.Spacer(width=10))
-    # Map display and header.
-    sched_app[1:8,  8:12] = pn.Column(pn.Spacer(height=10),
-                                      pn.Row(scheduler.map_title,styles={'background':'#048b8c'}),
-                                      pn.param.ParamMethod(scheduler.sky_map, loading_indicator=True))
-    # Map display parameters (map, nside, color palette)
-    sched_app[8:11, 8:12] = pn.Row(pn.pane.PNG(key_image, height=200),
-                                   pn.Column(pn.Param(scheduler,
-                                                      parameters=["survey_map","nside","color_palette"],
-                                                      show_name=False)))
-    # Debugging pane.
-    sched_app[11,   :]    = pn.Row(pn.Spacer(width=10),
-                                   pn.Column(pn.pane.Str(' Debugging',
-                                                         align='center',
-                                                         styles={'font-size':'10pt','color':'black'}),
-                                             terminal,
-                                             styles={'background':'#EDEDED'}),
-                                   pn.Spacer(width=10))
+
+    
+    # Fill the grid with updates held, so the page is laid out once.
+    with pn.io.hold():
+        sched_app = pn.GridSpec(sizing_mode='stretch_both', max_height=1000).servable()
+    
+        # Dashboard title.
+        sched_app[0,    :]    = pn.Row(scheduler._dashboard_title_pane,
+                                       pn.layout.HSpacer(),
+                                       logo_pane,
+                                       sizing_mode='stretch_width',
+                                       styles={'background':'#048b8c'})
+        # Parameter inputs (pickle, date, tier)
+        sched_app[1:4,  0:3]  = pn.Param(scheduler,
+                                         parameters=["scheduler_fname","date","tier"],
+                                         widgets={'scheduler_fname':{'widget_type':pn.widgets.TextInput,
+                                                                     'placeholder':'filepath or URL of pickle'},
+                                                  'date':pn.widgets.DatetimePicker},
+                                         name="Select pickle file, date and tier.")
+        # Survey rewards table and header.
+        sched_app[1:4,  3:8]  = pn.Row(pn.Spacer(width=10),
+                                       pn.Column(pn.Spacer(height=10),
+                                          pn.Row(scheduler._survey_rewards_title_pane,
+                                                 styles={'background':'#048b8c'}),
+                                          pn.param.ParamMethod(scheduler.survey_rewards_table, loading_indicator=True)),
+                                       pn.Spacer(width=10),
+                                       #height=200,
+                                       sizing_mode='stretch_height')
+        # Basis function table and header.
+        sched_app[4:11, 0:8]  = pn.Row(pn.Spacer(width=10),
+                                       pn.Column(pn.Spacer(height=10),
+                                          pn.Row(scheduler._basis_function_table_title_pane,
+                                                 styles={'background':'#048b8c'}),
+                                          pn.param.ParamMethod(scheduler.basis_function_table, loading_indicator=True)),
+                                       pn.Spacer(width=10))
+        # Map display and header.
+        sched_app[1:8,  8:12] = pn.Column(pn.Spacer(height=10),
+                                          pn.Row(scheduler._map_title_pane,styles={'background':'#048b8c'}),
+                                          pn.param.ParamMethod(scheduler.sky_map, loading_indicator=True, defer_load=True))
+        # Map display parameters (map, nside, color palette)
+        sched_app[8:11, 8:12] = pn.Row(key_image_pane,
+                                       pn.Column(pn.Param(scheduler,
+                                                          parameters=["survey_map","nside","color_palette"],
+                                                          show_name=False)))
+        # Debugging pane.
+        sched_app[11,   :]    = pn.Row(pn.Spacer(width=10),
+                                       pn.Column(pn.pane.Str(' Debugging',
+                                                             align='center',
+                                                             styles={'font-size':'10pt','color':'black'}),
+                                                 scheduler._terminal,
+                                                 styles={'background':'#EDEDED'}),
+                                       pn.Spacer(width=10))
 
     return sched_app
 
@@ -622,12 +872,19 @@ if __name__ == "__main__":
     else:
         scheduler_port = 8080
 
+    # Every session starts from the same empty dashboard (the pickle and date
+    # are chosen afterwards), so the first render of its document is cached
+    # and served to new connections. Each connection still gets a real
+    # session that runs scheduler_app.
+    pn.config.reuse_sessions = True
+
     pn.serve(
         scheduler_app,
-        port       = scheduler_port,
-        title      = "Scheduler Dashboard",
-        show       = True,
-        start      = True,
-        autoreload = True,
-        threaded   = True,
+        port        = scheduler_port,
+        title       = "Scheduler Dashboard",
+        show        = True,
+        start       = True,
+        autoreload  = True,
+        threaded    = True,
+        static_dirs = {ASSETS_URL.lstrip("/"): os.path.dirname(LOGO)},
     )
\ No newline at end of file